@@ -1,16 +1,28 @@
 # client/send_request.py
-# Local script to send download requests to your hosted server and poll status.
+# Local script to send download requests to your hosted server and follow job status
+# over the server's /events Server-Sent Events stream.
 # Usage:
 #   python send_request.py --server https://your-server.example --file urls.txt
 #
 # file `urls.txt` contains one URL per line (playlist or single video links)
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import json
 import time
 import argparse
 import os
 import sys
 
+# One keep-alive session for every call to the server; retries 429/5xx with exponential backoff
+# and hands the last response back (raise_on_status=False) so callers still see the status code.
+SESSION = requests.Session()
+_retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429,500,502,503,504], raise_on_status=False)
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=_retry)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
 def read_urls(file):
     with open(file, "r", encoding="utf-8") as f:
         lines = [l.strip() for l in f.readlines()]
@@ -22,7 +34,7 @@ def send(server, urls, name=None):
     payload = {"urls": urls}
     if name:
         payload["name"] = name
-    r = requests.post(endpoint, json=payload)
+    r = SESSION.post(endpoint, json=payload, timeout=(5, 30))
     if r.status_code not in (200,201,202):
         print("Failed to enqueue:", r.status_code, r.text)
         return None
@@ -31,18 +43,26 @@ def send(server, urls, name=None):
     return job_id
 
 def poll(server, job_id, interval=10):
-    url = server.rstrip("/") + f"/status/{job_id}"
+    # `interval` is the delay before reconnecting when the event stream drops
+    url = server.rstrip("/") + f"/events/{job_id}"
     while True:
-        r = requests.get(url)
-        if r.status_code != 200:
-            print("Status error:", r.status_code, r.text)
-            time.sleep(interval)
-            continue
-        job = r.json()
-        print("state:", job.get("state"), "| progress:", job.get("progress"))
-        if job.get("state") in ("done","error"):
-            print("final job info:", job.get("result") or job.get("error"))
-            return job
+        try:
+            # read timeout is above the server's keepalive interval, so it only fires on a dead stream
+            with SESSION.get(url, stream=True, timeout=(5, 30)) as r:
+                if r.status_code != 200:
+                    print("Status error:", r.status_code, r.text)
+                else:
+                    for line in r.iter_lines(decode_unicode=True):
+                        # skip blank separators and ": keepalive" comments
+                        if not line or not line.startswith("data:"):
+                            continue
+                        job = json.loads(line[len("data:"):])
+                        print("state:", job.get("state"), "| progress:", job.get("progress"))
+                        if job.get("state") in ("done","error","cancelled"):
+                            print("final job info:", job.get("result") or job.get("error"))
+                            return job
+        except requests.RequestException as e:
+            print("Event stream dropped:", e)
         time.sleep(interval)
 
 if __name__ == "__main__":
@@ -61,4 +81,4 @@ if __name__ == "__main__":
 
     job_id = send(args.server, urls, args.name)
     if job_id:
-        poll(args.server, job_id, interval=8)
+        poll(args.server, job_id, interval=3)
@@ -4,22 +4,67 @@
 # Usage: set DRIVE_TOKEN_FILE and DRIVE_CRED_FILE env vars or put token.json/credentials.json in same folder.
 
 import os
+import random
+import threading
+import time
+import httplib2
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, MediaUpload
 
 SCOPES = ["https://www.googleapis.com/auth/drive.file"]
+# retries for 429/5xx and connection errors; the client library sleeps 2**n + random() between tries
+# (for upload chunks it only retries statuses, see _execute_resumable)
+DRIVE_NUM_RETRIES = int(os.environ.get("DRIVE_NUM_RETRIES", 5))
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# bytes per resumable-upload request; each chunk is one HTTP round trip, and Drive
+# needs a multiple of 256 KiB, so this is set in whole MiB
+UPLOAD_CHUNKSIZE = int(os.environ.get("DRIVE_CHUNK_MB", 8)) * 1024 * 1024
+
+# Credentials shared by all threads: abs token path -> (token mtime, Credentials).
+# Expired ones are refreshed in place; the file is only read again when it changes
+# or a refresh fails.
+_CREDS = {}
+_CREDS_LOCK = threading.Lock()
 
 def _get_creds(token_file=None):
-    token_file = token_file or os.environ.get("DRIVE_TOKEN_FILE", "token.json")
+    token_file = os.path.abspath(token_file or os.environ.get("DRIVE_TOKEN_FILE", "token.json"))
     if not os.path.exists(token_file):
         raise FileNotFoundError(f"Drive token file not found: {token_file}")
-    creds = Credentials.from_authorized_user_file(token_file, SCOPES)
-    return creds
+    mtime = os.path.getmtime(token_file)
+    with _CREDS_LOCK:
+        cached = _CREDS.get(token_file)
+        if cached and cached[0] == mtime:
+            creds = cached[1]
+            if not creds.expired:
+                return creds
+            try:
+                creds.refresh(Request())
+                return creds
+            except Exception:
+                pass
+        creds = Credentials.from_authorized_user_file(token_file, SCOPES)
+        _CREDS[token_file] = (mtime, creds)
+        return creds
+
+# Built services, reused while their credentials are. httplib2 connections are not
+# thread-safe, so each thread keeps its own: abs token path -> (creds, service)
+_SERVICE_CACHE = threading.local()
 
 def get_service(token_file=None):
+    token_file = os.path.abspath(token_file or os.environ.get("DRIVE_TOKEN_FILE", "token.json"))
     creds = _get_creds(token_file)
-    service = build("drive", "v3", credentials=creds, cache_discovery=False)
+    cache = getattr(_SERVICE_CACHE, "services", None)
+    if cache is None:
+        cache = _SERVICE_CACHE.services = {}
+    cached = cache.get(token_file)
+    if cached and cached[0] is creds:
+        return cached[1]
+    # static_discovery loads the Drive v3 discovery doc bundled with the client library
+    service = build("drive", "v3", credentials=creds, cache_discovery=False, static_discovery=True)
+    cache[token_file] = (creds, service)
     return service
 
 def create_folder(name, parent_id=None, token_file=None):
@@ -27,16 +72,98 @@ def create_folder(name, parent_id=None, token_file=None):
     body = {"name": name, "mimeType": "application/vnd.google-apps.folder"}
     if parent_id:
         body["parents"] = [parent_id]
-    res = svc.files().create(body=body, fields="id").execute()
+    res = svc.files().create(body=body, fields="id").execute(num_retries=DRIVE_NUM_RETRIES)
     return res.get("id")
 
+def _execute_resumable(request):
+    # Like request.execute(num_retries=...), but also survives a dropped connection on a
+    # chunk PUT, which next_chunk() re-raises without retrying. After backing off,
+    # next_chunk() asks Drive how much of the session arrived and resumes from there.
+    failures = 0
+    response = None
+    while response is None:
+        try:
+            _, response = request.next_chunk(num_retries=DRIVE_NUM_RETRIES)
+        except (HttpError, OSError, httplib2.HttpLib2Error) as e:
+            if isinstance(e, HttpError) and e.resp.status not in RETRYABLE_STATUSES:
+                raise
+            failures += 1
+            if failures > DRIVE_NUM_RETRIES:
+                raise
+            time.sleep(2 ** failures + random.random())
+        else:
+            failures = 0
+    return response
+
 def upload_file(path, parent_id=None, token_file=None):
     svc = get_service(token_file)
     metadata = {"name": os.path.basename(path)}
     if parent_id:
         metadata["parents"] = [parent_id]
-    media = MediaFileUpload(path, resumable=True)
-    f = svc.files().create(body=metadata, media_body=media, fields="id,webViewLink,webContentLink").execute()
+    media = MediaFileUpload(path, chunksize=UPLOAD_CHUNKSIZE, resumable=True)
+    f = _execute_resumable(svc.files().create(body=metadata, media_body=media, fields="id,webViewLink,webContentLink"))
+    return {
+        "id": f.get("id"),
+        "webViewLink": f.get("webViewLink"),
+        "webContentLink": f.get("webContentLink")
+    }
+
+class _StreamUpload(MediaUpload):
+    # Resumable upload body read sequentially from a non-seekable stream (e.g. a pipe).
+    # size() is None, so the client uploads with an open-ended range and finishes on the
+    # first short read. MediaIoBaseUpload can't be used here: it seeks to find the size.
+    # on_eof, if given, is called at EOF and can raise to abort the upload instead of
+    # finalizing it with whatever the producer managed to write.
+    def __init__(self, fh, mimetype, chunksize, on_eof=None):
+        self._fh = fh
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._on_eof = on_eof
+        self._offset = 0          # stream offset of the first byte in _buf
+        self._buf = bytearray()   # bytes read but not yet acknowledged by Drive
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return None
+
+    def resumable(self):
+        return True
+
+    def getbytes(self, begin, length):
+        # Drive may re-request a chunk (retry) or accept only part of it, so keep
+        # everything from `begin` on; bytes before it are acknowledged and dropped.
+        if begin < self._offset:
+            raise ValueError("cannot rewind a streamed upload")
+        del self._buf[:begin - self._offset]
+        self._offset = begin
+        # read one byte past the chunk, so EOF is seen on the last chunk that carries data
+        while len(self._buf) <= length:
+            data = self._fh.read(length + 1 - len(self._buf))
+            if not data:
+                if self._on_eof:
+                    self._on_eof()
+                if len(self._buf) == length:
+                    # The stream ends exactly on a chunk boundary. An empty final chunk would
+                    # send an invalid Content-Range, so make this full chunk the short read:
+                    # next_chunk() compares against chunksize() after calling getbytes().
+                    self._chunksize = length + 1
+                break
+            self._buf += data
+        return bytes(self._buf[:length])
+
+def upload_stream(fh, name, mimetype, parent_id=None, token_file=None, chunksize=UPLOAD_CHUNKSIZE, on_eof=None):
+    # Upload everything read from `fh` until EOF without knowing its size up front.
+    svc = get_service(token_file)
+    metadata = {"name": name}
+    if parent_id:
+        metadata["parents"] = [parent_id]
+    media = _StreamUpload(fh, mimetype, chunksize, on_eof)
+    f = _execute_resumable(svc.files().create(body=metadata, media_body=media, fields="id,webViewLink,webContentLink"))
     return {
         "id": f.get("id"),
         "webViewLink": f.get("webViewLink"),
@@ -51,12 +178,12 @@ def make_shareable(file_id, token_file=None):
             fileId=file_id,
             body={"role":"reader", "type":"anyone"},
             fields="id"
-        ).execute()
+        ).execute(num_retries=DRIVE_NUM_RETRIES)
     except Exception:
         # permission might already exist; ignore
         pass
     # return webViewLink
-    f = svc.files().get(fileId=file_id, fields="id,webViewLink,webContentLink").execute()
+    f = svc.files().get(fileId=file_id, fields="id,webViewLink,webContentLink").execute(num_retries=DRIVE_NUM_RETRIES)
     return {
         "id": f.get("id"),
         "webViewLink": f.get("webViewLink"),
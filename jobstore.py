@@ -0,0 +1,370 @@
+# jobstore.py
+# Job records shared by server.py (enqueue + status) and worker.py (processing).
+#
+# Environment:
+# - REDIS_URL (optional) keep jobs in Redis hashes and queue them on a Redis list
+# - JOBS_DIR (optional) where job JSON files are kept without Redis; default "./jobs"
+#
+# Set REDIS_URL in production. The JSON-file store is for development only: jobs
+# are cached in memory and job_updates() waits on in-process conditions, so it only
+# works with a single server process that also runs the jobs.
+
+import os
+import threading
+import secrets
+import time
+from pathlib import Path
+import orjson
+
+JOBS_DIR = Path(os.environ.get("JOBS_DIR", "./jobs"))
+JOBS_DIR.mkdir(parents=True, exist_ok=True)
+
+TERMINAL_STATES = ("done", "error", "cancelled")
+
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL:
+    import redis
+    # job:<id> hash per job, one field per (JSON-encoded) value; updates published on job_events:<id>
+    rdb = redis.from_url(REDIS_URL, decode_responses=True)
+else:
+    rdb = None
+JOB_QUEUE = "job_queue"  # Redis list of job ids waiting for a worker
+JOB_NEW_CHANNEL = "job_new"  # pub/sub channel announcing each pushed job id
+
+# Job records are split in two: the immutable half (IMMUTABLE_FIELDS) is written once at
+# creation, progress updates only rewrite the small mutable half. On disk that is
+# jobs/<id>.json + jobs/<id>.state.json, in Redis the changed fields of the job:<id> hash.
+IMMUTABLE_FIELDS = ("id", "urls", "name", "created_at")
+PROGRESS_FIELDS = {"progress_current": "current", "progress_total": "total", "current_url": "current_url"}
+
+# In-memory job store (file mode only; with Redis the hashes are the only copy)
+jobs_lock = threading.Lock()
+jobs = {}  # job_id -> job dict
+job_conds = {}  # job_id -> threading.Condition notified on every update
+job_versions = {}  # job_id -> number of updates, guarded by the job's condition
+
+# Progress updates are coalesced: at most one write per FLUSH_INTERVAL seconds per job.
+FLUSH_INTERVAL = float(os.environ.get("JOB_FLUSH_INTERVAL", 0.5))
+_pending = {}  # job_id -> (fields, progress increment) not written yet
+_last_flush = {}  # job_id -> time.monotonic() of the last write
+_flush_timers = {}  # job_id -> threading.Timer writing _pending if no later update does
+
+def _flatten(job):
+    # nested job dict -> flat hash fields
+    progress = job["progress"]
+    return {
+        "id": job["id"],
+        "urls": job["urls"],
+        "name": job["name"],
+        "created_at": job["created_at"],
+        "state": job["state"],
+        "progress_current": progress["current"],
+        "progress_total": progress["total"],
+        "current_url": progress["current_url"],
+        "result": job["result"],
+        "error": job["error"],
+        "cancel_requested": job.get("cancel_requested", False),
+    }
+
+def _unflatten(fields):
+    return {
+        "id": fields["id"],
+        "urls": fields["urls"],
+        "name": fields["name"],
+        "state": fields["state"],
+        "progress": {
+            "current": fields["progress_current"],
+            "total": fields["progress_total"],
+            "current_url": fields["current_url"],
+        },
+        "result": fields["result"],
+        "error": fields["error"],
+        "cancel_requested": fields.get("cancel_requested", False),
+        "created_at": fields["created_at"],
+    }
+
+def _mutable_fields(job):
+    return {k: v for k, v in _flatten(job).items() if k not in IMMUTABLE_FIELDS}
+
+def _write_json(path, data):
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+def _read_json(path):
+    with open(path, "rb") as fh:
+        return orjson.loads(fh.read())
+
+def _save_new_job(job):
+    flat = _flatten(job)
+    if rdb is not None:
+        rdb.hset(f"job:{job['id']}", mapping={k: orjson.dumps(v) for k, v in flat.items()})
+        return
+    JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    _write_json(JOBS_DIR / f"{job['id']}.json", {k: flat[k] for k in IMMUTABLE_FIELDS})
+    _write_json(JOBS_DIR / f"{job['id']}.state.json", _mutable_fields(job))
+
+def _save_fields(job_id, fields, incr):
+    # caller holds jobs_lock
+    if rdb is not None:
+        key = f"job:{job_id}"
+        pipe = rdb.pipeline()
+        if fields:
+            pipe.hset(key, mapping={k: orjson.dumps(v) for k, v in fields.items()})
+        if incr:
+            # ints encode to bare digits, so HINCRBY works on the JSON-encoded field
+            pipe.hincrby(key, "progress_current", incr)
+        pipe.publish(f"job_events:{job_id}", orjson.dumps(fields))
+        pipe.execute()
+        return
+    _write_json(JOBS_DIR / f"{job_id}.state.json", _mutable_fields(jobs[job_id]))
+
+def _job_from_hash(fields):
+    if not fields:
+        return None
+    return _unflatten({k: orjson.loads(v) for k, v in fields.items()})
+
+def _load_redis_job(key):
+    return _job_from_hash(rdb.hgetall(key))
+
+def _load_redis_jobs(keys):
+    # one round trip for the whole page of keys
+    pipe = rdb.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    for fields in pipe.execute():
+        job = _job_from_hash(fields)
+        if job:
+            yield job
+
+def _load_job_file(job_id):
+    path = JOBS_DIR / f"{job_id}.json"
+    if not path.exists():
+        return None
+    job = _read_json(path)
+    state_path = JOBS_DIR / f"{job_id}.state.json"
+    if state_path.exists():
+        job = _unflatten({**job, **_read_json(state_path)})
+    # else: a job saved whole by an older version
+    return job
+
+def _load_existing_jobs():
+    for f in JOBS_DIR.glob("*.json"):
+        if f.name.endswith(".state.json"):
+            continue
+        try:
+            job = _load_job_file(f.stem)
+            jobs[job["id"]] = job
+        except Exception:
+            pass
+
+if rdb is None:
+    _load_existing_jobs()
+
+# fields every new job starts with; create_job fills in the rest
+# state: queued / running / uploading / done / error / cancelled
+_JOB_TEMPLATE = {"state": "queued", "result": None, "error": None, "cancel_requested": False}
+
+def create_job(urls, name=None):
+    # 96 random bits as 16 URL/filename-safe characters
+    jid = secrets.token_urlsafe(12)
+    job = _JOB_TEMPLATE.copy()
+    job.update(
+        id=jid,
+        urls=urls,
+        name=name or f"batch_{jid}",
+        progress={"current": 0, "total": len(urls), "current_url": None},
+        created_at=time.time(),
+    )
+    with jobs_lock:
+        if rdb is None:
+            jobs[jid] = job
+        _save_new_job(job)
+    return job
+
+def _job_cond(job_id):
+    with jobs_lock:
+        cond = job_conds.get(job_id)
+        if cond is None:
+            cond = job_conds[job_id] = threading.Condition()
+        return cond
+
+def _notify(job_id, finished=False):
+    # wake up any local job_updates() subscribers (Redis mode publishes instead)
+    if rdb is not None:
+        return
+    cond = _job_cond(job_id)
+    with cond:
+        job_versions[job_id] = job_versions.get(job_id, 0) + 1
+        cond.notify_all()
+    if finished:
+        # woken subscribers hold their own reference and will see the final state
+        with jobs_lock:
+            job_conds.pop(job_id, None)
+            job_versions.pop(job_id, None)
+
+def _flush(job_id, fields, incr):
+    # caller holds jobs_lock
+    timer = _flush_timers.pop(job_id, None)
+    if timer is not None:
+        timer.cancel()
+    _save_fields(job_id, fields, incr)
+    if fields.get("state") in TERMINAL_STATES:
+        _last_flush.pop(job_id, None)
+    else:
+        _last_flush[job_id] = time.monotonic()
+
+def _flush_pending(job_id):
+    # trailing write for held-back updates, so the last progress of a burst isn't lost
+    # when nothing else gets written after it
+    with jobs_lock:
+        pending = _pending.pop(job_id, None)
+        if pending is None:
+            return
+        _flush(job_id, *pending)
+    _notify(job_id)
+
+def _update(job_id, fields, incr=0, force=True):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            job["progress"]["current"] += incr
+            for k, v in fields.items():
+                if k in PROGRESS_FIELDS:
+                    job["progress"][PROGRESS_FIELDS[k]] = v
+                else:
+                    job[k] = v
+        # fold in whatever earlier throttled updates left unwritten
+        pending_fields, pending_incr = _pending.pop(job_id, ({}, 0))
+        pending_fields.update(fields)
+        pending_incr += incr
+        due = _last_flush.get(job_id, 0) + FLUSH_INTERVAL
+        if not force and time.monotonic() < due:
+            _pending[job_id] = (pending_fields, pending_incr)
+            if job_id not in _flush_timers:
+                timer = _flush_timers[job_id] = threading.Timer(due - time.monotonic(), _flush_pending, args=(job_id,))
+                timer.daemon = True
+                timer.start()
+            return
+        _flush(job_id, pending_fields, pending_incr)
+    _notify(job_id, fields.get("state") in TERMINAL_STATES)
+
+def update_job(job_id, **fields):
+    # Set mutable fields by their flat names: state, progress_total, current_url, result, error,
+    # cancel_requested.
+    # Always written right away; use for state transitions.
+    _update(job_id, fields)
+
+def maybe_update(job_id, **fields):
+    # Like update_job, but writes at most once per FLUSH_INTERVAL per job; fields held
+    # back are written with the job's next write, or by a timer when the interval ends.
+    _update(job_id, fields, force=False)
+
+def advance_progress(job_id, **fields):
+    # One more URL finished (HINCRBY in Redis), plus any other fields to set; throttled
+    # like maybe_update
+    _update(job_id, fields, incr=1, force=False)
+
+def request_cancel(job_id):
+    # the worker stops its downloads and skips the upload once it sees this
+    # (see worker.download_and_process)
+    update_job(job_id, cancel_requested=True)
+
+def cancel_requested(job_id):
+    if rdb is not None:
+        value = rdb.hget(f"job:{job_id}", "cancel_requested")
+        return bool(value and orjson.loads(value))
+    job = jobs.get(job_id)
+    return bool(job and job.get("cancel_requested"))
+
+def get_job(job_id):
+    if rdb is not None:
+        # Redis is the source of truth; the job may be running in another process
+        return _load_redis_job(f"job:{job_id}")
+    job = jobs.get(job_id)
+    if not job:
+        # try load from disk
+        job = _load_job_file(job_id)
+        if job:
+            jobs[job_id] = job
+    return job
+
+def job_updates(job_id, timeout):
+    # Yield the job after every update, or None when `timeout` seconds pass without one.
+    if rdb is not None:
+        pubsub = rdb.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(f"job_events:{job_id}")
+        try:
+            # subscribed before this read, so no update after it can be missed
+            yield get_job(job_id)
+            while True:
+                msg = pubsub.get_message(timeout=timeout)
+                yield get_job(job_id) if msg else None
+        finally:
+            pubsub.close()
+    else:
+        job = get_job(job_id)
+        if job is None or job["state"] in TERMINAL_STATES:
+            # nothing more will happen; don't create a condition nobody will clean up
+            yield job
+            return
+        cond = _job_cond(job_id)
+        seen = None
+        while True:
+            with cond:
+                # A finished job's version is dropped after its last notify (see _notify),
+                # so the state decides too. It is set before that notify, so reading it
+                # under the condition can't miss it.
+                job = get_job(job_id)
+                finished = job is None or job["state"] in TERMINAL_STATES
+                if not finished and job_versions.get(job_id, 0) == seen:
+                    cond.wait(timeout=timeout)
+                    job = get_job(job_id)
+                    finished = job is None or job["state"] in TERMINAL_STATES
+                version = job_versions.get(job_id, 0)
+            if finished:
+                yield job
+                return
+            yield job if version != seen else None
+            seen = version
+
+def iter_jobs(page=500):
+    # Yield every job without holding them all in memory; Redis is walked with SCAN
+    # (not the blocking KEYS) and read a page at a time.
+    if rdb is not None:
+        keys = []
+        for key in rdb.scan_iter(match="job:*", count=page):
+            keys.append(key)
+            if len(keys) >= page:
+                yield from _load_redis_jobs(keys)
+                keys = []
+        if keys:
+            yield from _load_redis_jobs(keys)
+        return
+    with jobs_lock:
+        snapshot = list(jobs.values())
+    yield from snapshot
+
+def push_job(job_id):
+    # hand a job to worker.py (Redis mode only): queue it, then wake idle workers
+    pipe = rdb.pipeline()
+    pipe.rpush(JOB_QUEUE, job_id)
+    pipe.publish(JOB_NEW_CHANNEL, job_id)
+    pipe.execute()
+
+def pop_job():
+    # next queued job id, or None if the queue is empty
+    return rdb.lpop(JOB_QUEUE)
+
+def watch_new_jobs(event):
+    # Set `event` whenever a job is pushed. Runs forever; start it in a daemon thread.
+    while True:
+        pubsub = rdb.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(JOB_NEW_CHANNEL)
+            for _ in pubsub.listen():
+                event.set()
+        except redis.RedisError as e:
+            print("job_new subscription dropped:", e)
+            time.sleep(1)
+        finally:
+            pubsub.close()
@@ -1,152 +1,43 @@
 # server.py
-# Flask server that accepts job requests, downloads videos with yt-dlp,
-# zips and uploads to Google Drive using drive_api.py.
+# Flask server that accepts job requests and serves job status. Jobs are processed
+# by worker.py: download videos with yt-dlp, archive and stream the archive to Google Drive.
 #
 # How it works:
 # - POST /enqueue  with JSON {"urls": ["url1","url2",...], "name": "optional batch name"}
 # - GET  /status/<job_id> to poll job status
+# - GET  /events/<job_id> Server-Sent Events stream of job state until it finishes
+# - WS   /stream/<job_id> WebSocket with the same job updates; send {"cmd": "cancel"} to stop
+#   the job (URLs not yet started are skipped and the job ends as "cancelled")
 #
 # Environment:
-# - DRIVE_TOKEN_FILE (optional) path to token.json
-# - PERSISTENT_DIR (optional) where downloads and zips are stored; default "./downloads"
+# - REDIS_URL (optional) job store + queue shared with worker.py; see jobstore.py
+# - SSE_KEEPALIVE (optional) seconds between keepalives on idle /events streams; default 15
+# Without REDIS_URL jobs run in a thread of this process (development only), so
+# worker.py's DRIVE_TOKEN_FILE / PERSISTENT_DIR / DL_CONCURRENCY apply here too.
 #
 # Run:
 #   pip install -r requirements.txt
-#   python server.py
+#   production (REDIS_URL set; see Procfile):
+#     gunicorn -k gevent -w 2 --worker-connections 1000 server:app
+#     python worker.py
+#   development:
+#     python server.py
 
 import os
-import uuid
 import threading
-import json
-import shutil
-import subprocess
-import time
-from pathlib import Path
-from flask import Flask, request, jsonify
-import drive_api
+from contextlib import closing
+from flask import Flask, request, jsonify, Response, stream_with_context
+from flask_sock import Sock
+import orjson
+import jobstore
 
 app = Flask(__name__)
+sock = Sock(app)
 
-PERSISTENT_DIR = Path(os.environ.get("PERSISTENT_DIR", "./downloads"))
-JOBS_DIR = Path(os.environ.get("JOBS_DIR", "./jobs"))
-PERSISTENT_DIR.mkdir(parents=True, exist_ok=True)
-JOBS_DIR.mkdir(parents=True, exist_ok=True)
-
-YT_DLP = os.environ.get("YTDLP_BIN", "yt-dlp")
-DRIVE_TOKEN_FILE = os.environ.get("DRIVE_TOKEN_FILE", "token.json")
-
-# In-memory job store (also saved to disk)
-jobs_lock = threading.Lock()
-jobs = {}  # job_id -> job dict
-
-def _save_job(job):
-    JOBS_DIR.mkdir(parents=True, exist_ok=True)
-    path = JOBS_DIR / f"{job['id']}.json"
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(job, f, indent=2)
-
-def _load_existing_jobs():
-    for f in JOBS_DIR.glob("*.json"):
-        try:
-            with open(f, "r", encoding="utf-8") as fh:
-                job = json.load(fh)
-                jobs[job["id"]] = job
-        except Exception:
-            pass
-
-_load_existing_jobs()
-
-def create_job(urls, name=None):
-    jid = str(uuid.uuid4())
-    job = {
-        "id": jid,
-        "urls": urls,
-        "name": name or f"batch_{jid[:8]}",
-        "state": "queued",   # queued / running / zipping / uploading / done / error
-        "progress": {"current": 0, "total": len(urls), "current_url": None},
-        "result": None,
-        "error": None,
-        "created_at": time.time()
-    }
-    with jobs_lock:
-        jobs[jid] = job
-        _save_job(job)
-    return job
-
-def update_job(job):
-    with jobs_lock:
-        jobs[job["id"]] = job
-        _save_job(job)
-
-def download_and_process(job_id):
-    job = jobs.get(job_id)
-    if not job:
-        return
-    job["state"] = "running"
-    update_job(job)
-
-    batch_folder = PERSISTENT_DIR / job_id
-    if batch_folder.exists():
-        shutil.rmtree(batch_folder, ignore_errors=True)
-    batch_folder.mkdir(parents=True, exist_ok=True)
-
-    try:
-        # Download loop
-        urls = job["urls"]
-        total = len(urls)
-        for idx, url in enumerate(urls, start=1):
-            job["progress"]["current"] = idx
-            job["progress"]["total"] = total
-            job["progress"]["current_url"] = url
-            update_job(job)
-
-            # run yt-dlp
-            out_template = str(batch_folder / "%(playlist_index)s - %(title)s.%(ext)s")
-            cmd = [YT_DLP, "-o", out_template, "--no-part", "--continue", "--restrict-filenames", url]
-            print("Running:", " ".join(cmd))
-            res = subprocess.run(cmd, capture_output=True, text=True)
-            if res.returncode != 0:
-                # record error but continue to try others
-                job["error"] = f"yt-dlp failed for {url}: {res.returncode} stdout:{res.stdout} stderr:{res.stderr}"
-                update_job(job)
-                # decide: continue or break — here we continue
-        # Zip everything
-        job["state"] = "zipping"
-        update_job(job)
-        zip_name = f"{job_id}.zip"
-        zip_path = PERSISTENT_DIR / zip_name
-        if zip_path.exists():
-            zip_path.unlink()
-        shutil.make_archive(str(zip_path).replace(".zip",""), 'zip', batch_folder)
-
-        # Upload zip to Drive
-        job["state"] = "uploading"
-        update_job(job)
-        # create a Drive folder for this batch
-        parent_folder_id = drive_api.create_folder(job["name"], token_file=DRIVE_TOKEN_FILE)
-        up = drive_api.upload_file(str(zip_path), parent_id=parent_folder_id, token_file=DRIVE_TOKEN_FILE)
-        # make shareable
-        share = drive_api.make_shareable(up["id"], token_file=DRIVE_TOKEN_FILE)
-
-        job["state"] = "done"
-        job["result"] = {
-            "drive_folder_id": parent_folder_id,
-            "zip_file_id": share["id"],
-            "webViewLink": share.get("webViewLink"),
-            "webContentLink": share.get("webContentLink")
-        }
-        update_job(job)
-
-    except Exception as e:
-        job["state"] = "error"
-        job["error"] = str(e)
-        update_job(job)
-    finally:
-        # cleanup local files (optional) — keep zip if you want
-        try:
-            shutil.rmtree(batch_folder, ignore_errors=True)
-        except Exception:
-            pass
+# seconds between SSE keepalive comments when a job has no updates
+SSE_KEEPALIVE = int(os.environ.get("SSE_KEEPALIVE", 15))
+# seconds a /stream socket waits for a job update before checking for client commands
+WS_COMMAND_POLL = 1
 
 @app.route("/enqueue", methods=["POST"])
 def enqueue():
@@ -155,36 +46,94 @@ def enqueue():
     name = data.get("name")
     if not urls or not isinstance(urls, list):
         return jsonify({"error": "send JSON with key 'urls' as a list of video/playlist urls"}), 400
-    job = create_job(urls, name)
-    # start background thread to process
-    t = threading.Thread(target=download_and_process, args=(job["id"],), daemon=True)
-    t.start()
+    job = jobstore.create_job(urls, name)
+    if jobstore.rdb is not None:
+        # worker.py picks it up from the queue
+        jobstore.push_job(job["id"])
+    else:
+        # dev mode: start background thread to process
+        import worker
+        t = threading.Thread(target=worker.download_and_process, args=(job["id"],), daemon=True)
+        t.start()
     return jsonify({"job_id": job["id"]}), 202
 
 @app.route("/status/<job_id>", methods=["GET"])
 def status(job_id):
-    job = jobs.get(job_id)
-    if not job:
-        # try load from disk
-        path = JOBS_DIR / f"{job_id}.json"
-        if path.exists():
-            with open(path, "r", encoding="utf-8") as fh:
-                job = json.load(fh)
-            jobs[job_id] = job
+    job = jobstore.get_job(job_id)
     if not job:
         return jsonify({"error":"job not found"}), 404
-    return jsonify(job)
+    return Response(orjson.dumps(job), mimetype="application/json")
+
+@app.route("/events/<job_id>", methods=["GET"])
+def events(job_id):
+    if not jobstore.get_job(job_id):
+        return jsonify({"error":"job not found"}), 404
+
+    def gen():
+        last = None
+        with closing(jobstore.job_updates(job_id, SSE_KEEPALIVE)) as updates:
+            for job in updates:
+                if job is None:
+                    # comment line keeps proxies from closing an idle stream
+                    yield b": keepalive\n\n"
+                    continue
+                payload = orjson.dumps(job)
+                if payload == last:
+                    continue
+                last = payload
+                yield b"data: " + payload + b"\n\n"
+                if job.get("state") in jobstore.TERMINAL_STATES:
+                    return
+
+    return Response(stream_with_context(gen()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@sock.route("/stream/<job_id>")
+def stream(ws, job_id):
+    if not jobstore.get_job(job_id):
+        ws.send(orjson.dumps({"error": "job not found"}).decode())
+        return
+    last = None
+    with closing(jobstore.job_updates(job_id, WS_COMMAND_POLL)) as updates:
+        for job in updates:
+            msg = ws.receive(timeout=0)
+            while msg is not None:
+                try:
+                    cmd = orjson.loads(msg).get("cmd")
+                except (orjson.JSONDecodeError, AttributeError):
+                    cmd = None
+                if cmd == "cancel":
+                    jobstore.request_cancel(job_id)
+                else:
+                    ws.send(orjson.dumps({"error": f"unknown command: {msg}"}).decode())
+                msg = ws.receive(timeout=0)
+            if job is None:
+                continue
+            payload = orjson.dumps(job)
+            if payload == last:
+                continue
+            last = payload
+            ws.send(payload.decode())
+            if job.get("state") in jobstore.TERMINAL_STATES:
+                return
+
+def _stream_json_list(items):
+    # encode one item at a time instead of building the whole array in memory
+    yield b"["
+    for i, item in enumerate(items):
+        yield (b"," if i else b"") + orjson.dumps(item)
+    yield b"]"
 
 @app.route("/jobs", methods=["GET"])
 def list_jobs():
-    with jobs_lock:
-        return jsonify(list(jobs.values()))
+    return Response(_stream_json_list(jobstore.iter_jobs()), mimetype="application/json")
 
 @app.route("/", methods=["GET"])
 def home():
     return jsonify({"message":"Auto-downloader server running"}), 200
 
 if __name__ == "__main__":
+    # development server; in production run gunicorn (see Procfile)
     # choose port with env PORT if hosting platform requires it
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
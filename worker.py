@@ -0,0 +1,407 @@
+# worker.py
+# Processes jobs queued by server.py: downloads videos with yt-dlp, archives them and
+# streams the archive to Google Drive using drive_api.py.
+#
+# Environment:
+# - REDIS_URL (required) same Redis as server.py; jobs are taken from its queue
+# - DRIVE_TOKEN_FILE (optional) path to token.json
+# - PERSISTENT_DIR (optional) where downloads are stored; default "./downloads"
+# - DL_CONCURRENCY (optional) URLs downloaded in parallel per batch; default 4
+# - CACHE_MAX_GB (optional) size of the downloaded-URL cache under PERSISTENT_DIR/cache; default 20
+# - PLAYLIST_CACHE_HOURS (optional) how long a cached playlist/channel is reused before
+#   it is checked for new videos; default 6
+# - ARCHIVE_FMT (optional) stored (zip, no compression; default) | deflated (zip) |
+#   zst (.tar.zst at level 1, needs `pip install zstandard`)
+#
+# Run:
+#   python worker.py
+#
+# Without REDIS_URL there is no queue; server.py then runs download_and_process
+# in a thread of its own process.
+
+import os
+import sys
+import fcntl
+import hashlib
+import threading
+import shutil
+import tarfile
+import time
+import zipfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from pathlib import Path
+import yt_dlp
+import drive_api
+import jobstore
+
+PERSISTENT_DIR = Path(os.environ.get("PERSISTENT_DIR", "./downloads"))
+PERSISTENT_DIR.mkdir(parents=True, exist_ok=True)
+
+# number of URLs downloaded in parallel per batch
+DL_CONCURRENCY = int(os.environ.get("DL_CONCURRENCY", 4))
+DRIVE_TOKEN_FILE = os.environ.get("DRIVE_TOKEN_FILE", "token.json")
+
+# Finished downloads are kept in CACHE_DIR/<sha1(url)>/ (complete once .done exists) and
+# hardlinked into each batch, so a video seen before is never downloaded again. The least
+# recently used entries are evicted once the cache grows past CACHE_MAX_GB. Each entry is
+# guarded by a flock on CACHE_DIR/<sha1(url)>.lock, so workers can share PERSISTENT_DIR.
+CACHE_DIR = PERSISTENT_DIR / "cache"
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_MAX_BYTES = int(float(os.environ.get("CACHE_MAX_GB", 20)) * 1024**3)
+# a playlist's .done says "playlist"; past this age the URL is downloaded again, which
+# only fetches the videos added since (files already there are skipped)
+PLAYLIST_CACHE_TTL = float(os.environ.get("PLAYLIST_CACHE_HOURS", 6)) * 3600
+
+# Video is already compressed, so deflating it burns CPU for ~1% smaller archives.
+ARCHIVE_FMT = os.environ.get("ARCHIVE_FMT", "stored")
+ARCHIVE_TYPES = {  # ARCHIVE_FMT -> (file extension, mimetype)
+    "stored": (".zip", "application/zip"),
+    "deflated": (".zip", "application/zip"),
+    "zst": (".tar.zst", "application/zstd"),
+}
+ARCHIVE_EXT, ARCHIVE_MIMETYPE = ARCHIVE_TYPES[ARCHIVE_FMT]
+if ARCHIVE_FMT == "zst":
+    import zstandard  # fail at startup, not after a whole batch has downloaded
+
+@lru_cache(maxsize=4096)
+def _cache_key(url):
+    return hashlib.sha1(url.encode()).hexdigest()
+
+@contextmanager
+def _cache_lock(key, blocking=True):
+    # Exclusive flock on the entry's lock file; yields False instead of waiting when
+    # blocking=False and someone else holds it. flock conflicts between separate open()s,
+    # so this works across threads as well as processes.
+    path = CACHE_DIR / f"{key}.lock"
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            yield False
+            return
+        try:
+            if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        # the holder removed the entry and its lock file while we waited; lock the new file
+        os.close(fd)
+    try:
+        yield True
+    finally:
+        os.close(fd)
+
+def _remove_entry(key):
+    # caller holds _cache_lock(key)
+    shutil.rmtree(CACHE_DIR / key, ignore_errors=True)
+    try:
+        os.unlink(CACHE_DIR / f"{key}.lock")
+    except FileNotFoundError:
+        pass
+
+def _cache_hit(done):
+    try:
+        st = os.stat(done)
+    except FileNotFoundError:
+        return False
+    if st.st_size and time.time() - st.st_mtime > PLAYLIST_CACHE_TTL:
+        return False
+    # atime marks it as recently used for eviction; mtime keeps the playlist's age
+    os.utime(done, (time.time(), st.st_mtime))
+    return True
+
+def _iter_files(path):
+    # Recursive os.scandir in name order. DirEntry answers is_dir()/is_file() from the
+    # directory listing and caches stat(), so callers stat each file at most once.
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for e in entries:
+        if e.is_dir(follow_symlinks=False):
+            yield from _iter_files(e.path)
+        elif e.is_file():
+            yield e
+
+def _link_tree(src, dst):
+    # hardlink every file under src into dst, keeping relative paths
+    for e in _iter_files(src):
+        if e.name != ".done":
+            target = dst / os.path.relpath(e.path, src)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.link(e.path, target)
+
+def _evict_cache():
+    entries = []
+    with os.scandir(CACHE_DIR) as it:
+        keys = [e.name for e in it if e.is_dir()]
+    for key in keys:
+        d = CACHE_DIR / key
+        try:
+            st = os.stat(d / ".done")
+            size = sum(e.stat().st_size for e in _iter_files(d))
+        except FileNotFoundError:
+            # still downloading, evicted by another worker, or left by a worker that died
+            # mid-download; only the last kind is unlocked and still without .done
+            with _cache_lock(key, blocking=False) as locked:
+                if locked and not (d / ".done").exists():
+                    _remove_entry(key)
+            continue
+        entries.append((st.st_atime, size, key))
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        # entries being linked into a batch right now are skipped
+        with _cache_lock(key, blocking=False) as locked:
+            if locked:
+                _remove_entry(key)
+                total -= size
+
+class _Cancelled(yt_dlp.utils.DownloadCancelled):
+    # yt-dlp re-raises DownloadCancelled even with ignoreerrors, so this still aborts
+    msg = "job cancelled"
+
+class _ErrorLog:
+    # yt-dlp logger that keeps the errors it reports and skips under ignoreerrors
+    def __init__(self):
+        self.errors = []
+
+    def debug(self, msg):
+        pass
+
+    def info(self, msg):
+        pass
+
+    def warning(self, msg):
+        print(msg, file=sys.stderr)
+
+    def error(self, msg):
+        print(msg, file=sys.stderr)
+        self.errors.append(msg)
+
+CANCEL_CHECK_INTERVAL = 1.0  # seconds between cancel checks from a running download
+
+def _download(job_id, url, out_dir):
+    # Returns the errors of playlist entries yt-dlp had to skip; raises if nothing came of it.
+    if jobstore.cancel_requested(job_id):
+        # the pool may start the next URL before download_and_process sees the request
+        raise _Cancelled()
+    started = False
+    checked = time.monotonic()
+
+    def hook(d):
+        # yt-dlp reports progress here; record which URL is actively downloading once it
+        # starts, and abort it if the job gets cancelled meanwhile
+        nonlocal started, checked
+        if d.get("status") != "downloading":
+            return
+        if not started:
+            started = True
+            jobstore.maybe_update(job_id, current_url=url)
+        now = time.monotonic()
+        if now - checked >= CANCEL_CHECK_INTERVAL:
+            checked = now
+            if jobstore.cancel_requested(job_id):
+                raise _Cancelled()
+
+    key = _cache_key(url)
+    entry = CACHE_DIR / key
+    done = entry / ".done"
+    # a URL repeated within or across concurrent batches downloads only once, and
+    # eviction can't remove the entry until it has been linked
+    log = _ErrorLog()
+    with _cache_lock(key):
+        if _cache_hit(done):
+            print("Cached:", url)
+        else:
+            refresh = done.exists()  # an expired playlist; its earlier download is still there
+            opts = {
+                "outtmpl": str(entry / "%(playlist_index)s - %(title)s.%(ext)s"),
+                "continuedl": True,
+                "nopart": True,
+                "restrictfilenames": True,
+                "concurrent_fragment_downloads": 4,
+                "progress_hooks": [hook],
+                # the CLI default: skip an unavailable video instead of failing the playlist
+                "ignoreerrors": "only_download",
+                "logger": log,
+                "quiet": True,
+            }
+            print("Downloading:", url)
+            try:
+                with yt_dlp.YoutubeDL(opts) as ydl:
+                    info = ydl.extract_info(url)
+                if not info or (log.errors and info.get("_type") != "playlist"):
+                    # a single video (or the extraction itself) failed; errors were only logged
+                    raise yt_dlp.utils.DownloadError(log.errors[-1] if log.errors else f"nothing extracted from {url}")
+            except Exception as e:
+                if isinstance(e, _Cancelled) or not refresh:
+                    # don't keep partial files: an entry without .done is never a hit
+                    _remove_entry(key)
+                    raise
+                # keep serving what the last run downloaded; the next expiry tries again
+                log.errors.append(f"refreshing failed, using the cached copy: {e}")
+                info = {"_type": "playlist"}
+            done.write_bytes(b"playlist" if info and info.get("_type") == "playlist" else b"")
+        # each URL gets its own subdir so files with the same name never collide
+        _link_tree(entry, out_dir)
+    return log.errors
+
+def _write_archive(fh, folder):
+    # entries are built from the DirEntry stat rather than zf.write()/tar.add(),
+    # which would stat every file again
+    if ARCHIVE_FMT == "zst":
+        with zstandard.ZstdCompressor(level=1).stream_writer(fh, closefd=False) as zw, \
+                tarfile.open(fileobj=zw, mode="w|") as tar:
+            for e in _iter_files(folder):
+                st = e.stat()
+                info = tarfile.TarInfo(os.path.relpath(e.path, folder))
+                info.size = st.st_size
+                info.mtime = st.st_mtime
+                info.mode = st.st_mode & 0o7777
+                with open(e.path, "rb") as src:
+                    tar.addfile(info, src)
+        return
+    compression = zipfile.ZIP_DEFLATED if ARCHIVE_FMT == "deflated" else zipfile.ZIP_STORED
+    with zipfile.ZipFile(fh, "w", compression, allowZip64=True) as zf:
+        for e in _iter_files(folder):
+            st = e.stat()
+            info = zipfile.ZipInfo(os.path.relpath(e.path, folder), time.localtime(st.st_mtime)[:6])
+            info.external_attr = (st.st_mode & 0xFFFF) << 16
+            info.file_size = st.st_size
+            info.compress_type = compression
+            with open(e.path, "rb") as src, zf.open(info, "w") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+def _upload_archive(folder, name, parent_id):
+    # A background thread archives into a pipe that feeds the Drive upload, so the archive
+    # never lands on disk and uploading overlaps with archiving.
+    rfd, wfd = os.pipe()
+    errors = []
+
+    def writer():
+        try:
+            with open(wfd, "wb") as w:
+                _write_archive(w, folder)
+        except Exception as e:
+            # includes BrokenPipeError when the upload side gave up first
+            errors.append(e)
+
+    def check_writer():
+        # the pipe also hits EOF when the writer fails; raise so Drive never gets a
+        # truncated archive as the final chunk (not an OSError, which the upload would retry)
+        t.join()
+        if errors:
+            raise RuntimeError(f"writing the archive failed: {errors[0]}") from errors[0]
+
+    t = threading.Thread(target=writer, daemon=True)
+    t.start()
+    try:
+        with open(rfd, "rb") as r:
+            up = drive_api.upload_stream(r, name, ARCHIVE_MIMETYPE, parent_id=parent_id,
+                                         token_file=DRIVE_TOKEN_FILE, on_eof=check_writer)
+    finally:
+        t.join()
+    if errors:
+        raise errors[0]
+    return up
+
+def download_and_process(job_id):
+    job = jobstore.get_job(job_id)
+    if not job:
+        return
+    if job.get("cancel_requested"):
+        # cancelled while still queued
+        jobstore.update_job(job_id, state="cancelled")
+        return
+    jobstore.update_job(job_id, state="running")
+
+    batch_folder = PERSISTENT_DIR / job_id
+    if batch_folder.exists():
+        shutil.rmtree(batch_folder, ignore_errors=True)
+    batch_folder.mkdir(parents=True, exist_ok=True)
+
+    try:
+        # Download loop: in-process yt-dlp per URL, DL_CONCURRENCY at a time
+        urls = job["urls"]
+        jobstore.update_job(job_id, progress_total=len(urls))
+        cancelled = False
+        with ThreadPoolExecutor(max_workers=DL_CONCURRENCY) as ex:
+            futures = {ex.submit(_download, job_id, url, batch_folder / f"{idx:03d}"): url
+                       for idx, url in enumerate(urls, start=1)}
+            for fut in as_completed(futures):
+                url = futures[fut]
+                if fut.cancelled():
+                    continue
+                if not cancelled and jobstore.cancel_requested(job_id):
+                    # drop the URLs that haven't started; running ones stop at their next hook
+                    cancelled = True
+                    for f in futures:
+                        f.cancel()
+                try:
+                    skipped = fut.result()
+                except Exception as e:
+                    if cancelled:
+                        # _Cancelled, or whatever else broke while aborting
+                        continue
+                    # record error but continue to try others
+                    jobstore.advance_progress(job_id, current_url=url, error=f"yt-dlp failed for {url}: {e}")
+                else:
+                    if skipped:
+                        # the rest of the playlist is still in the archive
+                        jobstore.advance_progress(job_id, current_url=url,
+                                                  error=f"yt-dlp skipped part of {url}: {skipped[0]}")
+                    else:
+                        jobstore.advance_progress(job_id, current_url=url)
+        # also catches a cancel that came in after the last download finished
+        if cancelled or jobstore.cancel_requested(job_id):
+            jobstore.update_job(job_id, state="cancelled")
+            return
+        # create a Drive folder for this batch
+        parent_folder_id = drive_api.create_folder(job["name"], token_file=DRIVE_TOKEN_FILE)
+
+        # Archive straight into the Drive upload
+        jobstore.update_job(job_id, state="uploading")
+        up = _upload_archive(batch_folder, f"{job_id}{ARCHIVE_EXT}", parent_folder_id)
+        # make shareable
+        share = drive_api.make_shareable(up["id"], token_file=DRIVE_TOKEN_FILE)
+
+        jobstore.update_job(job_id, state="done", result={
+            "drive_folder_id": parent_folder_id,
+            "zip_file_id": share["id"],
+            "webViewLink": share.get("webViewLink"),
+            "webContentLink": share.get("webContentLink")
+        })
+
+    except Exception as e:
+        jobstore.update_job(job_id, state="error", error=str(e))
+    finally:
+        # cleanup local files (the batch folder only holds hardlinks into the cache)
+        try:
+            shutil.rmtree(batch_folder, ignore_errors=True)
+            _evict_cache()
+        except Exception:
+            pass
+
+def main():
+    if jobstore.rdb is None:
+        sys.exit("worker.py needs REDIS_URL; without it server.py runs jobs itself")
+    # The job_new subscription wakes the loop as soon as a job is pushed; the timeout is
+    # only a fallback in case a notification is lost. Jobs still come from the list, so
+    # anything queued while no worker was running is picked up on start.
+    wakeup = threading.Event()
+    threading.Thread(target=jobstore.watch_new_jobs, args=(wakeup,), daemon=True).start()
+    print("Worker waiting for jobs")
+    while True:
+        job_id = jobstore.pop_job()
+        if job_id:
+            download_and_process(job_id)
+            continue
+        wakeup.wait(timeout=5)
+        wakeup.clear()
+
+if __name__ == "__main__":
+    main()